@@ -1,29 +1,48 @@
 import os
+
+# Under gunicorn's gevent worker, make blocking I/O cooperative before anything else is imported
+if os.environ.get("GEVENT"):
+    from gevent import monkey
+    monkey.patch_all()
+
 import json
 import uuid
-import psycopg2.extras
-from flask import Flask, request, jsonify, render_template, send_file
+from flask import Flask, request, jsonify, render_template, send_file, Response
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Table, TableStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, LongTable, TableStyle
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from reportlab.lib import colors
+from reportlab.pdfbase.pdfmetrics import stringWidth
 import io
-import re
+import hashlib
+import tempfile
 import random 
+import time
 import datetime
-
-# PostgreSQL specific imports
-import psycopg2
-from psycopg2 import sql
+import atexit
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from cachetools import TTLCache
+
+# PostgreSQL specific imports (psycopg 3 detects gevent's patched select on its own)
+import psycopg
+from psycopg.pq import TransactionStatus
+from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import ConnectionPool, PoolTimeout
 
 # Load environment variables from a .env file
 load_dotenv()
 
 # Configure the Gemini API with your API key
-genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
+# gRPC doesn't cooperate with gevent, so use the REST transport there
+genai.configure(api_key=os.environ.get("GEMINI_API_KEY"), transport="rest" if os.environ.get("GEVENT") else None)
 
 app = Flask(__name__)
 
@@ -35,72 +54,145 @@ DB_PASSWORD = os.environ.get("POSTGRES_DB_PASSWORD")
 DB_HOST = os.environ.get("POSTGRES_DB_HOST")
 DB_PORT = os.environ.get("POSTGRES_DB_PORT", 5432)
 
-def get_db_connection():
-    """Establishes a connection to the PostgreSQL database."""
+# Connection pool bounds. Keep DB_POOL_MAX (times the number of worker
+# processes) below the server's max_connections.
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 2))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 20))
+# Seconds to wait for a free (or newly opened) connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+
+def create_db_pool():
+    """Creates a thread-safe pool of PostgreSQL connections, opened in the background."""
     try:
         # Prioritize the single DATABASE_URL environment variable
         db_url = os.environ.get("DATABASE_URL")
         if db_url:
             # Connect using the URL string
-            conn = psycopg2.connect(db_url)
+            pool = ConnectionPool(db_url, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, open=True)
         else:
             # Fallback to individual variables
-            conn = psycopg2.connect(
-                dbname=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                host=DB_HOST,
-                port=DB_PORT
+            pool = ConnectionPool(
+                min_size=DB_POOL_MIN,
+                max_size=DB_POOL_MAX,
+                kwargs={
+                    "dbname": DB_NAME,
+                    "user": DB_USER,
+                    "password": DB_PASSWORD,
+                    "host": DB_HOST,
+                    "port": DB_PORT
+                },
+                open=True
             )
-        print("Database connection Successful")
-        return conn
-    except psycopg2.OperationalError as e:
+        print("Database connection pool created")
+        return pool
+    except psycopg.Error as e:
         print(f"Database connection failed: {e}")
         return None
-     
+
+POOL = create_db_pool()
+if POOL:
+    atexit.register(POOL.close)
+
+@contextmanager
+def db_conn():
+    """
+    Borrows a connection from the pool and returns it when the block exits.
+    Yields None if no connection could be obtained.
+    """
+    conn = None
+    if POOL:
+        try:
+            conn = POOL.getconn(timeout=DB_POOL_TIMEOUT)
+        except (psycopg.OperationalError, PoolTimeout) as e:
+            print(f"Database connection failed: {e}")
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            # End transactions left open by read-only queries or errors; the pool
+            # would otherwise roll them back itself and log a warning each time.
+            if not conn.closed and conn.info.transaction_status != TransactionStatus.IDLE:
+                try:
+                    conn.rollback()
+                except psycopg.Error:
+                    pass
+            # Broken connections are discarded by the pool
+            POOL.putconn(conn)
+
+# The whole schema is sent in a single round-trip
+SCHEMA_SQL = '''
+    CREATE TABLE IF NOT EXISTS quizzes (
+        id TEXT PRIMARY KEY,
+        user_name TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        total_questions INTEGER,
+        start_time TIMESTAMP NOT NULL,
+        end_time TIMESTAMP,
+        score INTEGER,
+        current_question_index INTEGER DEFAULT 0,
+        ai_summary JSONB
+    );
+
+    CREATE TABLE IF NOT EXISTS questions (
+        id SERIAL PRIMARY KEY,
+        quiz_id TEXT NOT NULL,
+        question_text TEXT NOT NULL,
+        options JSONB,
+        user_answer TEXT,
+        correct_answer TEXT,
+        is_correct BOOLEAN,
+        difficulty TEXT,
+        FOREIGN KEY (quiz_id) REFERENCES quizzes(id)
+    );
+
+    -- Migrate JSON columns created as TEXT by older versions
+    DO $$
+    BEGIN
+        IF (SELECT data_type FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'questions' AND column_name = 'options') = 'text' THEN
+            ALTER TABLE questions ALTER COLUMN options TYPE JSONB USING options::jsonb;
+        END IF;
+        IF (SELECT data_type FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'quizzes' AND column_name = 'ai_summary') = 'text' THEN
+            ALTER TABLE quizzes ALTER COLUMN ai_summary TYPE JSONB USING ai_summary::jsonb;
+        END IF;
+    END $$;
+
+    -- Index for the newest-first history listing
+    CREATE INDEX IF NOT EXISTS ix_quizzes_start_time ON quizzes (start_time DESC);
+    -- Lets get_history read MAX(end_time) for its ETag without scanning the table
+    CREATE INDEX IF NOT EXISTS ix_quizzes_end_time ON quizzes (end_time);
+    -- Index for per-quiz question lookups; also serves plain quiz_id filters
+    CREATE INDEX IF NOT EXISTS ix_questions_quiz_id_id ON questions (quiz_id, id DESC);
+'''
+INIT_DB_LOCK_ID = 42
+# Marks that this schema has been applied to this database, so warm starts skip the DDL.
+# Delete the file to force init_db to run again (e.g. after recreating the database).
+_schema_key = f"{os.environ.get('DATABASE_URL') or (DB_HOST, DB_PORT, DB_NAME)}{SCHEMA_SQL}"
+INIT_DB_STAMP = os.path.join(tempfile.gettempdir(), f"aqw_initdb_{hashlib.sha256(_schema_key.encode()).hexdigest()[:16]}.stamp")
 
 def init_db():
     """Initializes the database tables if they don't exist."""
-    conn = get_db_connection()
-    if not conn:
-        print("Could not connect to the database to initialize tables.")
+    if os.path.exists(INIT_DB_STAMP):
         return
+
+    with db_conn() as conn:
+        if not conn:
+            print("Could not connect to the database to initialize tables.")
+            return
+            
+        cur = conn.cursor()
         
-    cur = conn.cursor()
-    
-    # Create quizzes table
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS quizzes (
-            id TEXT PRIMARY KEY,
-            user_name TEXT NOT NULL,
-            topic TEXT NOT NULL,
-            total_questions INTEGER,
-            start_time TIMESTAMP NOT NULL,
-            end_time TIMESTAMP,
-            score INTEGER,
-            current_question_index INTEGER DEFAULT 0,
-            ai_summary TEXT
-        );
-    ''')
-    
-    # Create questions table
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS questions (
-            id SERIAL PRIMARY KEY,
-            quiz_id TEXT NOT NULL,
-            question_text TEXT NOT NULL,
-            options TEXT,
-            user_answer TEXT,
-            correct_answer TEXT,
-            is_correct BOOLEAN,
-            difficulty TEXT,
-            FOREIGN KEY (quiz_id) REFERENCES quizzes(id)
-        );
-    ''')
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+        # Only one worker runs the DDL; the lock is released on commit
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (INIT_DB_LOCK_ID,))
+        acquired = cur.fetchone()[0]
+        if acquired:
+            cur.execute(SCHEMA_SQL)
+        
+        conn.commit()
+        cur.close()
+
+    if acquired:
+        with open(INIT_DB_STAMP, 'w') as stamp:
+            stamp.write(datetime.datetime.now().isoformat())
 
 # Initialize the database tables when the app starts
 init_db()
@@ -121,59 +213,275 @@ def get_fallback_question(topic, difficulty):
         "difficulty": difficulty
     }
 
-def generate_question(topic, difficulty_level, retries=5):
+# Generated questions are pooled per (topic, difficulty) and reused across quizzes.
+# Bump Q_CACHE_VER whenever the prompt changes so stale questions are dropped.
+Q_CACHE_VER = "v2"
+QUESTION_CACHE_MIN_POOL = 3
+# Questions requested per Gemini call; the extras fill the cache pool
+QUESTION_BATCH_SIZE = 5
+QUESTION_CACHE = TTLCache(maxsize=512, ttl=3600)
+# Question texts already served to each quiz, so a quiz never sees a repeat
+SERVED_QUESTIONS = TTLCache(maxsize=4096, ttl=3600)
+QUESTION_CACHE_LOCK = threading.Lock()
+
+def get_cached_question(topic, difficulty, quiz_id, min_pool=QUESTION_CACHE_MIN_POOL, mark_served=True):
+    """
+    Returns a random cached question the quiz hasn't seen yet, or None. With
+    mark_served=False the question is only recorded once claim_question is called.
+    """
+    key = (Q_CACHE_VER, topic, difficulty)
+    with QUESTION_CACHE_LOCK:
+        pool = QUESTION_CACHE.get(key)
+        if not pool or len(pool) < min_pool:
+            return None
+        served = SERVED_QUESTIONS.get(quiz_id, set()) if quiz_id else set()
+        unseen = [q for q in pool if q['question'] not in served]
+        if not unseen:
+            return None
+        question_data = random.choice(unseen)
+        if quiz_id and mark_served:
+            SERVED_QUESTIONS[quiz_id] = served | {question_data['question']}
+        return dict(question_data)
+
+def claim_question(quiz_id, question_data):
+    """Records a question as served to the quiz; returns False if it already was."""
+    with QUESTION_CACHE_LOCK:
+        served = SERVED_QUESTIONS.get(quiz_id, set())
+        if question_data['question'] in served:
+            return False
+        SERVED_QUESTIONS[quiz_id] = served | {question_data['question']}
+        return True
+
+def cache_questions(topic, difficulty, questions):
+    """Adds freshly generated questions to the pool."""
+    key = (Q_CACHE_VER, topic, difficulty)
+    with QUESTION_CACHE_LOCK:
+        pool = QUESTION_CACHE.get(key)
+        if pool is None:
+            pool = deque(maxlen=100)
+            QUESTION_CACHE[key] = pool
+        pool.extend(dict(q) for q in questions)
+
+def is_valid_question(question_data):
+    """
+    Checks that a generated question has the expected shape and types. Items
+    go into the shared pool, so anything malformed here breaks every quiz on
+    that topic until it expires.
     """
-    Generates a question using the Gemini API with retries and a fallback.
+    return isinstance(question_data, dict) and \
+        all(key in question_data for key in ["question", "options", "answer", "difficulty"]) and \
+        isinstance(question_data["question"], str) and isinstance(question_data["answer"], str) and \
+        isinstance(question_data["options"], list) and len(question_data["options"]) == 4 and \
+        all(isinstance(option, str) for option in question_data["options"]) and \
+        question_data["answer"] in question_data["options"]
+
+JSON_DECODER = json.JSONDecoder()
+
+# Gemini errors worth retrying (rate limiting, timeouts, server errors), and the
+# time after which transient failures stop being retried and the fallback is used
+TRANSIENT_GEMINI_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+QUESTION_DEADLINE = 3.0
+# Timeout for a single Gemini call. It has its own budget, scaled to the batch
+# size, because one call generates QUESTION_BATCH_SIZE questions.
+GEMINI_CALL_TIMEOUT = float(os.environ.get("GEMINI_CALL_TIMEOUT", 2.0 * QUESTION_BATCH_SIZE))
+
+def extract_json(text, opening):
+    """Parses the JSON value that starts at the first `opening` character, ignoring any surrounding text."""
+    start = text.find(opening)
+    if start < 0:
+        raise ValueError(f"No JSON value starting with '{opening}' found in response")
+    value, _ = JSON_DECODER.raw_decode(text, start)
+    return value
+
+def generate_question(topic, difficulty_level, quiz_id=None, retries=5, mark_served=True):
+    """
+    Returns a question for the topic, served from the cache when possible and
+    otherwise generated with the Gemini API, with retries and a fallback.
+    Each API call generates a batch of questions; the rest are cached.
     """
     difficulty_map = ["easy", "medium", "hard"]
     selected_difficulty = difficulty_map[difficulty_level]
+
+    cached = get_cached_question(topic, selected_difficulty, quiz_id, mark_served=mark_served)
+    if cached:
+        return cached
+
     prompt = f"""
-    Generate a single, multiple-choice aptitude test question in JSON format about the topic: {topic}.
-    The question must be of '{selected_difficulty}' difficulty.
+    Generate {QUESTION_BATCH_SIZE} distinct, multiple-choice aptitude test questions in JSON format about the topic: {topic}.
+    Every question must be of '{selected_difficulty}' difficulty.
 
-    The JSON object must have the following keys:
+    Return a JSON array of objects. Each object must have the following keys:
     - "question": The main question text.
     - "options": A list containing exactly 4 detailed, relevant, and plausible options.
     - "answer": The correct option from the list.
     - "difficulty": "{selected_difficulty}"
 
-    Output ONLY the valid JSON object. Do not include any other text or code block markers.
+    Output ONLY the valid JSON array. Do not include any other text or code block markers.
     """
     
+    deadline = time.monotonic() + QUESTION_DEADLINE
     for attempt in range(retries):
+        if time.monotonic() >= deadline:
+            break
         try:
             model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content(prompt)
+            # Bound the call itself so a hung request can't block indefinitely
+            response = model.generate_content(prompt, request_options={"timeout": GEMINI_CALL_TIMEOUT})
             if not response.candidates:
                 continue
 
             text = response.text.strip()
-            match = re.search(r'\{.*\}', text, re.DOTALL)
-            if match:
-                json_string = match.group(0)
-                question_data = json.loads(json_string)
-                
-                if all(key in question_data for key in ["question", "options", "answer", "difficulty"]) and \
-                   isinstance(question_data["options"], list) and len(question_data["options"]) == 4 and \
-                   question_data["answer"] in question_data["options"]:
+            batch = extract_json(text, '[')
+            
+            # Drop malformed items rather than retrying the whole batch
+            questions = [q for q in batch if is_valid_question(q)] if isinstance(batch, list) else []
+            if questions:
+                cache_questions(topic, selected_difficulty, questions)
+                question_data = get_cached_question(topic, selected_difficulty, quiz_id, min_pool=1, mark_served=mark_served)
+                if question_data:
                     return question_data
-        except (json.JSONDecodeError, Exception) as e:
+            print(f"Attempt {attempt + 1} returned no usable questions.")
+            break
+        except TRANSIENT_GEMINI_ERRORS as e:
             print(f"Attempt {attempt + 1} failed: {e}")
+            # Exponential backoff with jitter, unless it would overrun the deadline
+            delay = 0.5 * 2 ** attempt + random.random() * 0.2
+            if time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+        except Exception as e:
+            # Malformed output or a non-transient error; retrying is unlikely to help
+            print(f"Attempt {attempt + 1} failed: {e}")
+            break
     
     print("All attempts failed. Using fallback question.")
     return get_fallback_question(topic, selected_difficulty)
 
-def create_pdf_report(quiz_data):
+# Next questions are generated in the background while the user is answering.
+# One future per difficulty, since the next difficulty depends on the answer.
+# Under gevent the workers are greenlets, so the pool can be sized to match the
+# worker's connection count instead of queueing prefetches behind each other.
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("PREFETCH_WORKERS", 256 if os.environ.get("GEVENT") else 8)))
+# How long a submission waits on a running prefetch before generating the question itself
+PREFETCH_TIMEOUT = 1.0
+PENDING = TTLCache(maxsize=4096, ttl=1800)
+PENDING_LOCK = threading.Lock()
+
+def prefetch_questions(topic, quiz_id):
     """
-    Creates a professionally styled PDF report for a completed quiz.
+    Starts generating the next question at every difficulty level. Only the one
+    that gets delivered is recorded as served, so discarded prefetches stay
+    available to the quiz.
     """
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
-    
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle('TitleStyle', parent=styles['Normal'], fontSize=20, spaceAfter=20, alignment=TA_CENTER, fontName='Helvetica-Bold')
-    heading_style = ParagraphStyle('HeadingStyle', parent=styles['Normal'], fontSize=14, spaceBefore=10, spaceAfter=5, fontName='Helvetica-Bold')
-    body_style = ParagraphStyle('BodyStyle', parent=styles['Normal'], fontSize=10, spaceAfter=5, alignment=TA_LEFT)
+    with PENDING_LOCK:
+        for level in range(3):
+            PENDING[(quiz_id, level)] = EXECUTOR.submit(generate_question, topic, level, quiz_id, mark_served=False)
+
+def discard_prefetched_questions(quiz_id, keep_level=None):
+    """Cancels the quiz's pending prefetches, returning the one for keep_level if any."""
+    with PENDING_LOCK:
+        futures = {level: PENDING.pop((quiz_id, level), None) for level in range(3)}
+    kept = futures.pop(keep_level, None)
+    for future in futures.values():
+        if future:
+            future.cancel()
+    return kept
+
+def get_next_question(topic, difficulty_level, quiz_id):
+    """
+    Returns the prefetched question for the chosen difficulty, generating it
+    synchronously if no prefetch exists, it is still queued, or it doesn't
+    finish within PREFETCH_TIMEOUT.
+    """
+    future = discard_prefetched_questions(quiz_id, keep_level=difficulty_level)
+    # cancel() only succeeds for a prefetch still waiting for a worker; waiting on it would be pointless
+    if future and not future.cancel():
+        try:
+            question_data = future.result(timeout=PREFETCH_TIMEOUT)
+            if claim_question(quiz_id, question_data):
+                return question_data
+        except Exception as e:
+            # A prefetch that is already running can't be interrupted, but its batch still fills the pool
+            future.cancel()
+            print(f"Prefetched question unavailable: {e}")
+    return generate_question(topic, difficulty_level, quiz_id)
+
+# Answers are buffered per quiz and inserted in a single batch when the quiz ends
+QUIZ_BUFFERS = TTLCache(maxsize=10000, ttl=6 * 3600)
+# Correctness of each quiz's last two answers, which drives the adaptive difficulty
+RECENT = TTLCache(maxsize=10000, ttl=6 * 3600)
+QUIZ_BUFFERS_LOCK = threading.Lock()
+
+def buffer_answer(quiz_id, row, is_correct):
+    """Buffers an answer row and returns the correctness of the quiz's last two answers."""
+    with QUIZ_BUFFERS_LOCK:
+        rows = QUIZ_BUFFERS.get(quiz_id)
+        if rows is None:
+            rows = []
+            QUIZ_BUFFERS[quiz_id] = rows
+        rows.append(row)
+        recent = RECENT.get(quiz_id)
+        if recent is None:
+            recent = deque(maxlen=2)
+            RECENT[quiz_id] = recent
+        recent.append(is_correct)
+        return list(recent)
+
+def flush_answers(cur, quiz_id):
+    """Inserts the quiz's buffered answers in one statement. The caller commits."""
+    with QUIZ_BUFFERS_LOCK:
+        rows = QUIZ_BUFFERS.pop(quiz_id, None)
+        RECENT.pop(quiz_id, None)
+    if rows:
+        # executemany pipelines the rows, so this is a single round-trip
+        cur.executemany(
+            "INSERT INTO questions (quiz_id, question_text, options, user_answer, correct_answer, is_correct, difficulty) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+            rows
+        )
+
+# Report styles are built once and shared by every PDF build
+styles = getSampleStyleSheet()
+title_style = ParagraphStyle('TitleStyle', parent=styles['Normal'], fontSize=20, spaceAfter=20, alignment=TA_CENTER, fontName='Helvetica-Bold')
+heading_style = ParagraphStyle('HeadingStyle', parent=styles['Normal'], fontSize=14, spaceBefore=10, spaceAfter=5, fontName='Helvetica-Bold')
+body_style = ParagraphStyle('BodyStyle', parent=styles['Normal'], fontSize=10, spaceAfter=5, alignment=TA_LEFT)
+CORRECT_TEXT = "Correct ✅"
+INCORRECT_TEXT = "Incorrect ❌"
+# Breakdown table column widths, and the cell padding ReportLab applies on each side
+QUESTION_TABLE_COL_WIDTHS = [20, 200, 100, 100, 60]
+TABLE_CELL_PADDING = 6
+
+def table_cell(text, col_width):
+    """
+    Returns the text as a plain table cell when it fits on one line, which is
+    much cheaper to lay out, and as a wrapping Paragraph otherwise.
+    """
+    if '<' in text or stringWidth(text, 'Helvetica', 10) > col_width - 2 * TABLE_CELL_PADDING:
+        return Paragraph(text, body_style)
+    return text
+
+# Reports are built in the background; finished PDFs are cached so repeat downloads are free.
+# ReportLab is CPU-bound: under gevent, EXECUTOR's workers are greenlets and a build would stall
+# every connection, so reports go to gevent's native-thread pool there instead.
+if os.environ.get("GEVENT"):
+    from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+    PDF_EXECUTOR = NativeThreadPoolExecutor(max_workers=2)
+else:
+    PDF_EXECUTOR = EXECUTOR
+PDF_JOBS = TTLCache(maxsize=1024, ttl=600)
+PDF_CACHE = TTLCache(maxsize=256, ttl=3600)
+PDF_LOCK = threading.Lock()
+
+def create_pdf_report(quiz_data, output):
+    """
+    Creates a professionally styled PDF report for a completed quiz and
+    writes it to the file-like output.
+    """
+    doc = SimpleDocTemplate(output, pagesize=letter)
     
     story = []
 
@@ -186,18 +494,17 @@ def create_pdf_report(quiz_data):
     story.append(Paragraph(f"<b>Final Score:</b> {score_display} / {quiz_data['total_questions']}", body_style))
     story.append(Spacer(1, 12))
 
-    # AI Analysis Section
+    # AI Analysis Section (ai_summary is JSONB, so psycopg has already decoded it)
     ai_analysis = {}
-    summary_text = quiz_data.get('ai_summary', "Analysis not available.")
+    summary = quiz_data.get('ai_summary')
     
-    if summary_text and summary_text != "Analysis not available.":
-        try:
-            ai_analysis = json.loads(summary_text)
-        except (json.JSONDecodeError, TypeError):
-            ai_analysis = {
-                "performance_summary": summary_text,
-                "recommendations": "No recommendations available."
-            }
+    if isinstance(summary, dict):
+        ai_analysis = summary
+    elif summary:
+        ai_analysis = {
+            "performance_summary": str(summary),
+            "recommendations": "No recommendations available."
+        }
     else:
         ai_analysis = {
             "performance_summary": f"Could not generate a detailed analysis. Your final score was {score_display}/{quiz_data['total_questions']}.",
@@ -217,18 +524,18 @@ def create_pdf_report(quiz_data):
     
     questions_data = quiz_data.get('questions', [])
     
+    _, question_width, answer_width, correct_width, _ = QUESTION_TABLE_COL_WIDTHS
     table_data = [['#', 'Question', 'Your Answer', 'Correct Answer', 'Result']]
-    
-    for idx, q_row in enumerate(questions_data):
-        q = dict(q_row)
-        correct_status = "Correct ✅" if q['is_correct'] else "Incorrect ❌"
-        table_data.append([
+    table_data += [
+        [
             str(idx + 1),
-            Paragraph(q['question_text'], body_style),
-            Paragraph(q['user_answer'], body_style),
-            Paragraph(q['correct_answer'], body_style),
-            correct_status
-        ])
+            table_cell(q['question_text'], question_width),
+            table_cell(q['user_answer'], answer_width),
+            table_cell(q['correct_answer'], correct_width),
+            CORRECT_TEXT if q['is_correct'] else INCORRECT_TEXT
+        ]
+        for idx, q in enumerate(questions_data)
+    ]
         
     table_style = TableStyle([
         ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#F0F0F0')),
@@ -241,14 +548,18 @@ def create_pdf_report(quiz_data):
         ('BACKGROUND', (0, 1), (-1, -1), colors.white)
     ])
     
-    question_table = Table(table_data, colWidths=[20, 200, 100, 100, 60])
+    # LongTable lays out row by row, which is cheaper for quizzes that span many pages
+    question_table = LongTable(table_data, colWidths=QUESTION_TABLE_COL_WIDTHS)
     question_table.setStyle(table_style)
     story.append(question_table)
     
     doc.build(story)
-    buffer.seek(0)
-    
-    return buffer
+
+def build_pdf_report(quiz_data):
+    """Builds the PDF report in memory and returns its bytes."""
+    buffer = io.BytesIO()
+    create_pdf_report(quiz_data, buffer)
+    return buffer.getvalue()
 
 @app.route('/')
 def index():
@@ -264,18 +575,19 @@ def start_quiz():
         return jsonify({"error": "Username and topic are required"}), 400
 
     quiz_id = str(uuid.uuid4())
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
-
-    cur = conn.cursor()
-    cur.execute("INSERT INTO quizzes (id, user_name, topic, total_questions, start_time, current_question_index) VALUES (%s, %s, %s, %s, NOW(), %s)",
-                (quiz_id, username, topic, num_questions, 0))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_conn() as conn:
+        if not conn:
+            return jsonify({"error": "Database connection failed"}), 500
+
+        cur = conn.cursor()
+        cur.execute("INSERT INTO quizzes (id, user_name, topic, total_questions, start_time, current_question_index) VALUES (%s, %s, %s, %s, NOW(), %s)",
+                    (quiz_id, username, topic, num_questions, 0))
+        conn.commit()
+        cur.close()
     
-    first_question = generate_question(topic, 1) # Start with medium
+    first_question = generate_question(topic, 1, quiz_id) # Start with medium
+    if num_questions > 1:
+        prefetch_questions(topic, quiz_id)
     
     return jsonify({
         "quiz_id": quiz_id,
@@ -297,38 +609,38 @@ def submit_and_next():
     correct_answer = question_data['answer']
     is_correct = (user_answer == correct_answer)
     
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    with db_conn() as conn:
+        if not conn:
+            return jsonify({"error": "Database connection failed"}), 500
+        cur = conn.cursor(row_factory=dict_row)
     
-    cur.execute("SELECT * FROM quizzes WHERE id = %s", (quiz_id,))
-    quiz_info = cur.fetchone()
-    if not quiz_info or quiz_info['current_question_index'] >= quiz_info['total_questions']:
-        cur.close()
-        conn.close()
-        return jsonify({"status": "quiz_finished"})
+        cur.execute("SELECT topic, total_questions, current_question_index FROM quizzes WHERE id = %s", (quiz_id,))
+        quiz_info = cur.fetchone()
+        if not quiz_info or quiz_info['current_question_index'] >= quiz_info['total_questions']:
+            cur.close()
+            return jsonify({"status": "quiz_finished"})
 
-    cur.execute("INSERT INTO questions (quiz_id, question_text, options, user_answer, correct_answer, is_correct, difficulty) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                (quiz_id, question_data['question'], json.dumps(question_data['options']), user_answer, correct_answer, is_correct, question_data['difficulty']))
-    conn.commit()
+        recent_questions_status = buffer_answer(quiz_id, (quiz_id, question_data['question'], Jsonb(question_data['options']), user_answer, correct_answer, is_correct, question_data['difficulty']), is_correct)
 
-    new_index = current_index + 1
+        new_index = current_index + 1
     
-    if new_index >= quiz_info['total_questions']:
-        cur.execute("UPDATE quizzes SET end_time = NOW(), current_question_index = %s WHERE id = %s", (new_index, quiz_id))
-        conn.commit()
+        if new_index >= quiz_info['total_questions']:
+            # Write all answers and the final progress in one transaction and one round-trip
+            with conn.pipeline():
+                flush_answers(cur, quiz_id)
+                cur.execute("UPDATE quizzes SET end_time = NOW(), current_question_index = %s WHERE id = %s", (new_index, quiz_id))
+            conn.commit()
+            cur.close()
+            discard_prefetched_questions(quiz_id)
+            return jsonify({"status": "quiz_finished"})
+
         cur.close()
-        conn.close()
-        return jsonify({"status": "quiz_finished"})
 
     # Adaptive logic to determine the next question's difficulty
     next_difficulty_level = 1 # Default to medium
-    cur.execute("SELECT is_correct FROM questions WHERE quiz_id = %s ORDER BY id DESC LIMIT 2", (quiz_id,))
-    recent_questions_status = cur.fetchall()
     
     if len(recent_questions_status) == 2:
-        correct_count = sum(1 for q in recent_questions_status if q['is_correct'])
+        correct_count = sum(1 for is_correct in recent_questions_status if is_correct)
         if correct_count == 2:
             next_difficulty_level = 2 # Two correct -> Hard
         elif correct_count == 0:
@@ -336,17 +648,15 @@ def submit_and_next():
         else:
             next_difficulty_level = 1 # One of each -> Medium
     elif len(recent_questions_status) == 1:
-        if recent_questions_status[0]['is_correct']:
+        if recent_questions_status[0]:
             next_difficulty_level = 2 # One correct -> Hard
         else:
             next_difficulty_level = 0 # One incorrect -> Easy
-    
-    next_question = generate_question(quiz_info['topic'], next_difficulty_level)
-    
-    cur.execute("UPDATE quizzes SET current_question_index = %s WHERE id = %s", (new_index, quiz_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+
+    # Fetch outside the connection block so waiting on Gemini doesn't hold a pooled connection
+    next_question = get_next_question(quiz_info['topic'], next_difficulty_level, quiz_id)
+    if new_index + 1 < quiz_info['total_questions']:
+        prefetch_questions(quiz_info['topic'], quiz_id)
 
     return jsonify({
         "status": "success",
@@ -361,30 +671,41 @@ def analyze_quiz():
     if not quiz_id:
         return jsonify({"error": "Quiz ID is required"}), 400
         
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    with db_conn() as conn:
+        if not conn:
+            return jsonify({"error": "Database connection failed"}), 500
+        discard_prefetched_questions(quiz_id)
+
+        # The statements are pipelined: they go out together and their results come back in one round-trip.
+        # The score is counted in SQL so the UPDATE doesn't have to wait for the SELECT's results.
+        with conn.pipeline():
+            cur = conn.cursor(row_factory=dict_row)
+            # The quiz may end early (e.g. on timeout) with answers still buffered
+            flush_answers(cur, quiz_id)
+            cur.execute("SELECT * FROM questions WHERE quiz_id = %s ORDER BY id", (quiz_id,))
+            quiz_cur = conn.cursor(row_factory=dict_row)
+            quiz_cur.execute("""
+                UPDATE quizzes
+                SET score = (SELECT COUNT(*) FROM questions WHERE quiz_id = %s AND is_correct), end_time = NOW()
+                WHERE id = %s
+                RETURNING user_name, topic, total_questions, score
+            """, (quiz_id, quiz_id))
+            results = cur.fetchall()
+            quiz_info = quiz_cur.fetchone()
+        conn.commit()
+        cur.close()
+        quiz_cur.close()
 
-    cur.execute("SELECT * FROM questions WHERE quiz_id = %s", (quiz_id,))
-    results = cur.fetchall()
-    
-    total_score = sum(1 for r in results if r['is_correct'])
-    total_questions = len(results)
-    
-    cur.execute("UPDATE quizzes SET score = %s, end_time = NOW() WHERE id = %s",
-                (total_score, quiz_id))
-    conn.commit()
+    if not quiz_info:
+        return jsonify({"error": "Quiz not found"}), 404
 
-    cur.execute("SELECT * FROM quizzes WHERE id = %s", (quiz_id,))
-    quiz_info = cur.fetchone()
-    cur.close()
-    conn.close()
+    total_score = quiz_info['score']
+    total_questions = len(results)
 
     prompt = f"""
     Analyze the quiz performance for user '{quiz_info['user_name']}' on the topic '{quiz_info['topic']}'.
     The user's final score was {total_score} out of {quiz_info['total_questions']}.
-    Here are the results of each question: {json.dumps([dict(r) for r in results])}.
+    Here are the results of each question: {json.dumps(results)}.
     Provide a detailed, professional analysis in two distinct sections.
     1. A **Performance Summary**: Begin with an overall evaluation of the user's performance. Mention their score and highlight specific strengths and weaknesses (e.g., "The user demonstrated strong knowledge in X but struggled with Y, particularly in 'hard' difficulty questions.").
     2. **Actionable Recommendations & Resources**: Based on the weaknesses identified, provide a clear, step-by-step plan for improvement. Suggest specific concepts to review and provide an example search query for each. Recommend a variety of learning resources, such as textbooks, online courses, and YouTube channels. Be encouraging and concise.
@@ -395,16 +716,15 @@ def analyze_quiz():
     try:
         model = genai.GenerativeModel('gemini-1.5-flash')
         response = model.generate_content(prompt)
-        ai_analysis = json.loads(response.text.strip())
+        ai_analysis = extract_json(response.text, '{')
         
-        conn = get_db_connection()
-        if conn:
-            cur = conn.cursor()
-            cur.execute("UPDATE quizzes SET ai_summary = %s WHERE id = %s",
-                        (json.dumps(ai_analysis), quiz_id))
-            conn.commit()
-            cur.close()
-            conn.close()
+        with db_conn() as conn:
+            if conn:
+                cur = conn.cursor()
+                cur.execute("UPDATE quizzes SET ai_summary = %s WHERE id = %s",
+                            (Jsonb(ai_analysis), quiz_id))
+                conn.commit()
+                cur.close()
     except (json.JSONDecodeError, Exception) as e:
         print(f"AI analysis failed with error: {e}")
         ai_analysis = {
@@ -412,46 +732,123 @@ def analyze_quiz():
             "recommendations": "Please try again later or focus on the topics you found difficult."
         }
     
+    # The score and summary changed, so any report built earlier is stale
+    with PDF_LOCK:
+        PDF_CACHE.pop(quiz_id, None)
+        PDF_JOBS.pop(quiz_id, None)
+    
     return jsonify({"analysis": ai_analysis})
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+# Serialized history pages keyed by ETag, so unchanged pages skip the query and JSON encoding
+HISTORY_CACHE = TTLCache(maxsize=64, ttl=30)
+HISTORY_CACHE_LOCK = threading.Lock()
+
 @app.route('/get_history', methods=['GET'])
 def get_history():
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("SELECT id, user_name, topic, start_time, score, total_questions FROM quizzes ORDER BY start_time DESC")
-    history = cur.fetchall()
-    cur.close()
-    conn.close()
+    limit = request.args.get('limit', HISTORY_PAGE_SIZE, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    limit = min(max(limit, 1), HISTORY_MAX_PAGE_SIZE)
+    offset = max(offset, 0)
+
+    # Clients revalidate on every request and get a 304 while the history is unchanged
+    headers = {"Cache-Control": "private, no-cache"}
+
+    with db_conn() as conn:
+        if not conn:
+            return jsonify({"error": "Database connection failed"}), 500
+        cur = conn.cursor(row_factory=dict_row)
+        # New quizzes move MAX(start_time); finishing or scoring a quiz moves MAX(end_time).
+        # Both are answered from an index, so this stays cheaper than the page query it guards.
+        cur.execute("SELECT MAX(start_time) AS last_start, MAX(end_time) AS last_end FROM quizzes")
+        version = cur.fetchone()
+        etag = hashlib.sha1(f"{version['last_start']}:{version['last_end']}:{limit}:{offset}".encode()).hexdigest()
+        headers["ETag"] = f'"{etag}"'
+
+        if etag in request.if_none_match:
+            cur.close()
+            return Response(status=304, headers=headers)
+
+        with HISTORY_CACHE_LOCK:
+            body = HISTORY_CACHE.get(etag)
+        if body is None:
+            cur.execute("SELECT id, user_name, topic, start_time, score, total_questions FROM quizzes ORDER BY start_time DESC LIMIT %s OFFSET %s",
+                        (limit, offset))
+            body = app.json.dumps(cur.fetchall())
+            with HISTORY_CACHE_LOCK:
+                HISTORY_CACHE[etag] = body
+        cur.close()
     
-    return jsonify([dict(row) for row in history])
-
-@app.route('/download_report/<quiz_id>', methods=['GET'])
-def download_report(quiz_id):
-    conn = get_db_connection()
-    if not conn:
-        return "Report or quiz not found", 404
-
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("SELECT * FROM quizzes WHERE id = %s", (quiz_id,))
-    quiz_info = cur.fetchone()
-
-    cur.execute("SELECT * FROM questions WHERE quiz_id = %s", (quiz_id,))
-    questions_data = cur.fetchall()
+    return Response(body, mimetype='application/json', headers=headers)
+
+def load_report_data(quiz_id):
+    """Loads a quiz and its questions for the PDF report, or returns None if there is nothing to report."""
+    with db_conn() as conn:
+        if not conn:
+            return None
+
+        cur = conn.cursor(row_factory=dict_row)
+        # The quiz and its questions in one round-trip, with only the columns the PDF report uses.
+        # A quiz without questions has no report, so an inner join is enough.
+        cur.execute('''
+            SELECT q.user_name, q.topic, q.start_time, q.score, q.total_questions, q.ai_summary,
+                   qu.question_text, qu.user_answer, qu.correct_answer, qu.is_correct
+            FROM quizzes q
+            JOIN questions qu ON qu.quiz_id = q.id
+            WHERE q.id = %s
+            ORDER BY qu.id
+        ''', (quiz_id,))
+        rows = cur.fetchall()
 
-    cur.close()
-    conn.close()
+        cur.close()
     
-    if not quiz_info or not questions_data:
-        return "Report or quiz not found", 404
+    if not rows:
+        return None
         
-    quiz_data = dict(quiz_info)
-    quiz_data['questions'] = [dict(q) for q in questions_data]
-    
-    pdf_buffer = create_pdf_report(quiz_data)
-    
-    return send_file(pdf_buffer, as_attachment=True, download_name=f"quiz_report_{quiz_id}.pdf", mimetype='application/pdf')
+    quiz_data = {key: rows[0][key] for key in ('user_name', 'topic', 'start_time', 'score', 'total_questions', 'ai_summary')}
+    quiz_data['questions'] = [
+        {key: row[key] for key in ('question_text', 'user_answer', 'correct_answer', 'is_correct')}
+        for row in rows
+    ]
+    return quiz_data
+
+@app.route('/download_report/<quiz_id>', methods=['GET'])
+def download_report(quiz_id):
+    """
+    Serves the quiz's PDF report. The first request starts building it in the
+    background and returns 202; poll the same URL until the PDF is returned.
+    """
+    url = f"/download_report/{quiz_id}"
+    with PDF_LOCK:
+        pdf_bytes = PDF_CACHE.get(quiz_id)
+        job = PDF_JOBS.get(quiz_id)
+
+    if pdf_bytes is None:
+        if job is None:
+            quiz_data = load_report_data(quiz_id)
+            if not quiz_data:
+                return "Report or quiz not found", 404
+            with PDF_LOCK:
+                job = PDF_JOBS.get(quiz_id)
+                if job is None:
+                    job = PDF_EXECUTOR.submit(build_pdf_report, quiz_data)
+                    PDF_JOBS[quiz_id] = job
+
+        if not job.done():
+            return jsonify({"status": "pending", "url": url}), 202
+
+        with PDF_LOCK:
+            PDF_JOBS.pop(quiz_id, None)
+        try:
+            pdf_bytes = job.result()
+        except Exception as e:
+            print(f"PDF report generation failed: {e}")
+            return "Report generation failed", 500
+        with PDF_LOCK:
+            PDF_CACHE[quiz_id] = pdf_bytes
+
+    return send_file(io.BytesIO(pdf_bytes), as_attachment=True, download_name=f"quiz_report_{quiz_id}.pdf", mimetype='application/pdf')
 
 if __name__ == "__main__":
     app.run(debug=True, port=5500)